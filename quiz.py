@@ -1,47 +1,109 @@
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from google import genai
 from google.genai import types as genai_types
 from dotenv import load_dotenv
+import asyncio
+import concurrent.futures
+import hashlib
+import io
 import os
-import json
 import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+import httpx
 import openai
-from openai import OpenAI
+import orjson
+from openai import AsyncOpenAI
+from PIL import Image as PILImage, ImageOps, UnidentifiedImageError
+from pydantic import BaseModel, Field
 
 load_dotenv()
 
-app = Flask(__name__)
 
-gemini_client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+class ORJSONProvider(JSONProvider):
+    """Serves jsonify() and request.get_json() through orjson."""
 
-DIFFICULTIES = ["Easy", "Medium", "Hard", "Very Hard"]
-CATEGORIES = [
-    "General",
-    "History",
-    "Fun Fact",
-    "Records/Statistics",
-]
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
 
-@app.route("/quiz", methods=["POST"])
-def quiz():
-    if "image" not in request.files:
-        return jsonify({"error": "image required"}), 400
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
-    image = request.files["image"]
-    difficulty = request.form.get("difficulty", "Medium").strip().title()
-    category = request.form.get("category", "General")
 
-    if difficulty not in DIFFICULTIES or category not in CATEGORIES:
-        return jsonify({"error": "invalid difficulty or category"}), 400
+# Uploads larger than this are rejected before they are parsed. Kept at
+# hypercorn's default wsgi_max_body_size so the CLI entrypoint enforces the
+# same cap without extra configuration.
+MAX_UPLOAD_BYTES = 16 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
-    # 1. Gemini describes the exact object
-    image_bytes = image.read()
-    gemini_response = gemini_client.models.generate_content(
-    model="gemini-2.5-pro",
-    contents=[
-        genai_types.Part.from_bytes(data=image_bytes, mime_type=image.mimetype),
-        """
+app = Flask(__name__)
+app.json = ORJSONProvider(app)
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+
+# Both clients are only used from llm_loop, so their pooled
+# keep-alive connections are reused across requests
+gemini_client = genai.Client(
+    api_key=os.getenv("GEMINI_API_KEY"),
+    http_options=genai_types.HttpOptions(timeout=60_000),
+)
+openai_client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+        timeout=60,
+    ),
+)
+
+DIFFICULTIES = frozenset({"Easy", "Medium", "Hard", "Very Hard"})
+CATEGORIES = frozenset({
+    "General",
+    "History",
+    "Fun Fact",
+    "Records/Statistics",
+})
+DEFAULT_DIFFICULTY = "Medium"
+DEFAULT_CATEGORY = "General"
+
+
+GPT_SYSTEM_PROMPT = "You are a precise but friendly quiz generator. Always reply with valid JSON only."
+
+# Quiz requests that arrive within this window are sent to GPT together.
+QUIZ_BATCH_WINDOW = 0.05
+QUIZ_BATCH_MAX = 8
+
+# Matches a reply wrapped in a ```json ... ``` markdown fence
+FENCE_RE = re.compile(r"^\s*```(?:json)?\s*\n?(.*?)\n?\s*```\s*$", re.DOTALL | re.IGNORECASE)
+
+# Gemini only needs a small view of the photo to describe it
+GEMINI_IMAGE_MAX_SIZE = (1024, 1024)
+GEMINI_IMAGE_QUALITY = 80
+
+DESCRIPTION_CACHE_SIZE = 512
+QUIZ_CACHE_SIZE = 512
+# Cached quizzes expire so prompt changes reach repeat uploads
+QUIZ_CACHE_TTL = 24 * 60 * 60
+# Shared by every worker process and kept across restarts
+QUIZ_CACHE_DB = os.getenv("QUIZ_CACHE_DB", "quiz_cache.db")
+# Each cache table is pruned back to this many rows every CACHE_DB_PRUNE_EVERY
+# writes from a worker
+CACHE_DB_MAX_ROWS = 50_000
+CACHE_DB_PRUNE_EVERY = 100
+
+# The quiz.json debug artifact is only written in debug mode or when
+# QUIZ_PERSIST=1
+QUIZ_PERSIST = os.getenv("QUIZ_PERSIST") == "1"
+# Read once at import, while no other thread can race the temporary change
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+GEMINI_PROMPT = """
 Describe the main subject of the image in a simple, grounded, visual way.
 
 GOALS:
@@ -57,50 +119,9 @@ RULES:
 - Context should be simple and visual (e.g., "on a table", "outdoors").
 - Category_general should be a broad type (e.g., "food", "vehicle", "animal", "tool", "electronics", "furniture").
 - Materials should include only the most obvious ones.
-
-OUTPUT ONLY valid JSON with this structure:
-
-{
-  "description": "1–2 sentence simple description of the main subject.",
-  "brand": "Visible or iconic brand, or 'unknown brand'.",
-  "model": "Visible or iconic model, or 'unknown model'.",
-  "year": "Visible year, rough era if truly obvious, or 'unknown year'.",
-  "color": "Main visible colors.",
-  "condition": "Basic visible condition.",
-  "style": "Simple style descriptor.",
-  "category_general": "Broad category like 'food', 'vehicle', 'tool', 'electronics', etc.",
-  "material": "Main visible materials.",
-  "context": "Short visual context like 'on a table', 'in a kitchen', 'outdoors'.",
-  "size": "Simple size descriptor like 'small', 'medium', 'large'.",
-  "notable_features": "Key features that stand out visually."
-}
-
-No markdown. No commentary. JSON only.
 """
-    ]
-)
-    desc = gemini_response.text
 
-    try:
-        # handle possible ```json ... ``` wrapping
-        cleaned = desc.strip()
-        if cleaned.startswith("```"):
-            cleaned = cleaned.strip("`")
-            # naive split to remove language marker if present
-            if cleaned.lower().startswith("json"):
-                cleaned = cleaned[4:].strip()
-        obj = json.loads(cleaned)
-    except Exception:
-        obj = {"description": desc}
-
-    # Save Gemini description to description.txt
-    with open("description.txt", "w", encoding="utf-8") as f:
-        f.write(json.dumps(obj, indent=2, ensure_ascii=False))
-
-    # 2. GPT creates quiz + hint
-    # GPT will ALWAYS put the correct answer as the FIRST option.
-    # We'll shuffle them afterwards and compute the new correct_index.
-    gpt_prompt = f"""
+GPT_RULES = """
 You are a professional quiz creator for a production mobile app.
 
 You are given:
@@ -235,7 +256,7 @@ OUTPUT FORMAT
 ============================================================
 Return ONLY valid JSON in this structure:
 
-{{
+{
   "question": "Full text: background + question.",
   "options": [
     "Correct answer FIRST",
@@ -246,62 +267,480 @@ Return ONLY valid JSON in this structure:
   "hint": "Difficulty-scaled hint.",
   "explanation": "Short explanation of why the correct answer is correct."
   "title": "Very short title for object/question"
-}}
+}
+"""
 
+# GPT_RULES contains literal JSON braces, so escape them for str.format
+_GPT_RULES_TMPL = GPT_RULES.replace("{", "{{").replace("}", "}}")
+
+GPT_PROMPT_TMPL = _GPT_RULES_TMPL + """
 ============================================================
 INPUTS
 ============================================================
-Object description (ground truth): {json.dumps(obj, ensure_ascii=False)}
+Object description (ground truth): {obj_json}
 Category: {category}
 Difficulty: {difficulty}
 
 Generate the quiz now.
 """
 
-    gpt_response = openai_client.chat.completions.create(
+GPT_BATCH_PROMPT_TMPL = _GPT_RULES_TMPL + """
+============================================================
+BATCH MODE
+============================================================
+You are given {count} independent inputs below, each with an integer "id".
+Apply every rule above to each input on its own and create exactly ONE quiz
+per input.
+
+Return ONLY valid JSON in this structure, where every quiz has the fields
+described above plus an "id" field copied from its input:
+
+{{"quizzes": [<quiz with "id": 0>, <quiz with "id": 1>, ...]}}
+
+============================================================
+INPUTS
+============================================================
+{inputs}
+
+Generate the quizzes now.
+"""
+
+
+class ObjectDescription(BaseModel):
+    """Response schema Gemini fills in for the main subject of the image."""
+
+    description: str = Field(description="1–2 sentence simple description of the main subject.")
+    brand: str = Field(description="Visible or iconic brand, or 'unknown brand'.")
+    model: str = Field(description="Visible or iconic model, or 'unknown model'.")
+    year: str = Field(description="Visible year, rough era if truly obvious, or 'unknown year'.")
+    color: str = Field(description="Main visible colors.")
+    condition: str = Field(description="Basic visible condition.")
+    style: str = Field(description="Simple style descriptor.")
+    category_general: str = Field(description="Broad category like 'food', 'vehicle', 'tool', 'electronics', etc.")
+    material: str = Field(description="Main visible materials.")
+    context: str = Field(description="Short visual context like 'on a table', 'in a kitchen', 'outdoors'.")
+    size: str = Field(description="Simple size descriptor like 'small', 'medium', 'large'.")
+    notable_features: str = Field(description="Key features that stand out visually.")
+
+
+class LRUCache:
+    """Small thread-safe LRU mapping that evicts the oldest entry on overflow."""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.data:
+                return None
+            stored_at, value = self.data[key]
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return value
+
+    def put(self, key, value, stored_at=None):
+        with self.lock:
+            self.data[key] = (time.time() if stored_at is None else stored_at, value)
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+
+class SQLiteCache:
+    """LRUCache for the hottest entries in front of a SQLite table.
+
+    Values are stored as orjson bytes alongside the time they were written,
+    so the TTL holds no matter which worker wrote the row. Database access
+    runs on a worker thread so a busy write lock never stalls the LLM loop,
+    and is best-effort: a failed read is a miss and a failed write is logged.
+    Each cache owns its connection, so its lock covers every use of it.
+    """
+
+    def __init__(self, path, table, key_columns, maxsize, ttl=None, max_rows=CACHE_DB_MAX_ROWS):
+        self.conn = open_cache_db(path)
+        self.memory = LRUCache(maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.puts = 0
+        self.lock = threading.Lock()
+        where = " AND ".join(f"{column} = ?" for column in key_columns)
+        columns = ", ".join(key_columns)
+        placeholders = ", ".join("?" for _ in key_columns)
+        self.select_sql = f"SELECT value, stored_at FROM {table} WHERE {where}"
+        self.delete_sql = f"DELETE FROM {table} WHERE {where}"
+        self.insert_sql = (
+            f"INSERT OR REPLACE INTO {table} ({columns}, value, stored_at) "
+            f"VALUES ({placeholders}, ?, ?)"
+        )
+        self.expire_sql = f"DELETE FROM {table} WHERE stored_at < ?"
+        self.trim_sql = (
+            f"DELETE FROM {table} WHERE rowid IN "
+            f"(SELECT rowid FROM {table} ORDER BY stored_at DESC LIMIT -1 OFFSET ?)"
+        )
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                f"{', '.join(key_columns)}, value BLOB NOT NULL, stored_at REAL NOT NULL, "
+                f"PRIMARY KEY ({columns}))"
+            )
+            self.conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {table}_stored_at ON {table} (stored_at)"
+            )
+
+    async def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        try:
+            return await asyncio.to_thread(self._load, key)
+        except (sqlite3.Error, orjson.JSONDecodeError):
+            app.logger.warning("Cache read failed; treating it as a miss", exc_info=True)
+            return None
+
+    async def put(self, key, value):
+        stored_at = time.time()
+        self.memory.put(key, value, stored_at=stored_at)
+        try:
+            await asyncio.to_thread(self._store, key, orjson.dumps(value), stored_at)
+        except sqlite3.Error:
+            app.logger.warning("Cache write failed; keeping the entry in memory only", exc_info=True)
+
+    def _load(self, key):
+        with self.lock:
+            row = self.conn.execute(self.select_sql, key).fetchone()
+            if row is None:
+                return None
+            raw, stored_at = row
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                with self.conn:
+                    self.conn.execute(self.delete_sql, key)
+                return None
+
+        value = orjson.loads(raw)
+        self.memory.put(key, value, stored_at=stored_at)
+        return value
+
+    def _store(self, key, raw, stored_at):
+        with self.lock, self.conn:
+            self.conn.execute(self.insert_sql, (*key, raw, stored_at))
+            self.puts += 1
+            if self.puts % CACHE_DB_PRUNE_EVERY == 0:
+                self._prune()
+
+    def _prune(self):
+        # Drop expired rows, then keep only the newest max_rows entries
+        if self.ttl is not None:
+            self.conn.execute(self.expire_sql, (time.time() - self.ttl,))
+        self.conn.execute(self.trim_sql, (self.max_rows,))
+
+
+def open_cache_db(path):
+    conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+    # WAL lets workers read while another one writes
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+# (sha256 of image bytes, mimetype) -> parsed Gemini description
+description_cache = SQLiteCache(
+    QUIZ_CACHE_DB, "desc_cache", ("h", "mime"), DESCRIPTION_CACHE_SIZE
+)
+# (sha256 of image bytes, category, difficulty) -> GPT quiz, correct answer first
+quiz_cache = SQLiteCache(
+    QUIZ_CACHE_DB, "quiz_cache", ("h", "cat", "diff"), QUIZ_CACHE_SIZE, ttl=QUIZ_CACHE_TTL
+)
+
+
+def start_llm_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+# Flask runs every async view in its own short-lived event loop, but the SDK
+# clients' connection pools are tied to the loop they were first used on, so
+# every LLM call runs on one long-lived loop in a background thread.
+llm_loop = start_llm_loop()
+
+
+async def run_on_llm_loop(coro):
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, llm_loop))
+
+
+def write_json(path, data):
+    # Write to a temp file and swap it in so readers never see a partial file
+    path = Path(path)
+    payload = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    f = tempfile.NamedTemporaryFile("wb", dir=path.parent, prefix=f".{path.name}.", delete=False)
+    try:
+        with f:
+            f.write(payload)
+        # NamedTemporaryFile is created 0600; give it the usual umask mode
+        os.chmod(f.name, 0o666 & ~UMASK)
+        os.replace(f.name, path)
+    except BaseException:
+        os.unlink(f.name)
+        raise
+
+
+def flatten_to_rgb(im):
+    # JPEG has no alpha, and a plain convert("RGB") turns transparent pixels
+    # black, so composite cut-outs and logos onto white first
+    if im.mode not in ("RGBA", "LA", "PA", "RGBa", "La") and "transparency" not in im.info:
+        return im.convert("RGB")
+    rgba = im.convert("RGBA")
+    background = PILImage.new("RGB", rgba.size, "white")
+    background.paste(rgba, mask=rgba.getchannel("A"))
+    return background
+
+
+def downscale_image(image_bytes, mime_type):
+    """Shrinks an upload to a small JPEG, or returns it untouched if PIL can't read it."""
+    buf = io.BytesIO()
+    try:
+        im = ImageOps.exif_transpose(PILImage.open(io.BytesIO(image_bytes)))
+        im.thumbnail(GEMINI_IMAGE_MAX_SIZE)
+        flatten_to_rgb(im).save(buf, "JPEG", quality=GEMINI_IMAGE_QUALITY, optimize=True)
+    except (UnidentifiedImageError, PILImage.DecompressionBombError, OSError, ValueError):
+        # Includes huge-dimension images Pillow refuses to decode
+        return image_bytes, mime_type
+    return buf.getvalue(), "image/jpeg"
+
+
+def read_upload(file_storage, size_hint):
+    """Reads an upload in chunks into one buffer preallocated from Content-Length."""
+    buf = bytearray(size_hint)
+    n = 0
+    while chunk := file_storage.stream.read(UPLOAD_CHUNK_SIZE):
+        # Fills the preallocated space in place, growing only if the hint was short
+        buf[n:n + len(chunk)] = chunk
+        n += len(chunk)
+    del buf[n:]
+    return buf
+
+
+def unfence(text):
+    m = FENCE_RE.match(text)
+    return m.group(1) if m else text.strip()
+
+
+async def persist_json(path, data):
+    if app.debug or QUIZ_PERSIST:
+        await asyncio.to_thread(write_json, path, data)
+
+
+def build_gpt_prompt(obj_json, category, difficulty):
+    return GPT_PROMPT_TMPL.format_map(
+        {"obj_json": obj_json, "category": category, "difficulty": difficulty}
+    )
+
+
+def build_batch_gpt_prompt(entries):
+    inputs = orjson.dumps(
+        [
+            {
+                "id": i,
+                "object_description": orjson.Fragment(obj_json),
+                "category": category,
+                "difficulty": difficulty,
+            }
+            for i, (obj_json, category, difficulty) in enumerate(entries)
+        ],
+        option=orjson.OPT_INDENT_2,
+    ).decode()
+    return GPT_BATCH_PROMPT_TMPL.format_map({"count": len(entries), "inputs": inputs})
+
+
+def is_valid_quiz(quiz):
+    options = quiz.get("options") if isinstance(quiz, dict) else None
+    return isinstance(options, list) and len(options) >= 2
+
+
+async def request_quiz(gpt_prompt):
+    gpt_response = await openai_client.chat.completions.create(
         model="gpt-4o",
         temperature=0.8,
+        stream=True,
+        response_format={"type": "json_object"},
         messages=[
-            {"role": "system", "content": "You are a precise but friendly quiz generator. Always reply with valid JSON only."},
+            {"role": "system", "content": GPT_SYSTEM_PROMPT},
             {"role": "user", "content": gpt_prompt},
         ],
     )
 
-    quiz_text = gpt_response.choices[0].message.content.strip()
+    # Collect the streamed fragments and parse once at the end
+    parts = []
+    async for chunk in gpt_response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
 
-    # Strip ```json ... ``` if GPT wraps it
-    if quiz_text.startswith("```"):
-        quiz_text = quiz_text.strip("`")
-        # remove leading language marker if present
-        if quiz_text.lower().startswith("json"):
-            quiz_text = quiz_text[4:].strip()
+    # JSON mode should never fence its reply, but stay tolerant if it does
+    return orjson.loads(unfence("".join(parts)))
 
-    quiz = json.loads(quiz_text)
 
-    # Save GPT quiz output to quiz.txt
-    with open("quiz.txt", "w", encoding="utf-8") as f:
-        f.write(json.dumps(quiz, indent=2, ensure_ascii=False))
+async def describe_image(image_bytes, mime_type, image_hash):
+    """Returns (description, cacheable); cacheable is False for the raw-text fallback."""
+    cache_key = (image_hash, mime_type)
+    obj = await description_cache.get(cache_key)
+    if obj is not None:
+        return obj, True
 
-    # 3. Shuffle options while tracking the correct answer index
-    options = quiz.get("options", [])
-    if not options or len(options) < 2:
-        return jsonify({"error": "LLM did not return enough options"}), 500
+    image_bytes, mime_type = await asyncio.to_thread(downscale_image, image_bytes, mime_type)
 
-    # We assume the FIRST option is correct before shuffling
-    correct_answer = options[0]
+    gemini_response = await gemini_client.aio.models.generate_content(
+        model="gemini-2.5-flash",
+        contents=[
+            genai_types.Part.from_bytes(data=image_bytes, mime_type=mime_type),
+            GEMINI_PROMPT,
+        ],
+        config=genai_types.GenerateContentConfig(
+            response_mime_type="application/json",
+            response_schema=ObjectDescription,
+        ),
+    )
 
-    # Create a shuffled copy of the options
-    shuffled_options = options[:]
-    random.shuffle(shuffled_options)
+    if gemini_response.parsed is None:
+        # Not cached, so the next upload of this image asks Gemini again
+        return {"description": gemini_response.text}, False
+
+    obj = gemini_response.parsed.model_dump()
+    await description_cache.put(cache_key, obj)
+    return obj, True
+
+
+class QuizBatcher:
+    """Coalesces quiz generations that arrive close together into one GPT call.
+
+    The queue and the GPT calls live on llm_loop, and requests wait on a
+    thread-safe future.
+    """
+
+    def __init__(self, loop, window=QUIZ_BATCH_WINDOW, max_batch=QUIZ_BATCH_MAX):
+        self.window = window
+        self.max_batch = max_batch
+        self.loop = loop
+        self.queue = None
+
+    def _put(self, item):
+        # Runs on self.loop, so the queue and its drain task are created there
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            self.loop.create_task(self._drain())
+        self.queue.put_nowait(item)
+
+    async def generate(self, obj_json, category, difficulty):
+        future = concurrent.futures.Future()
+        self.loop.call_soon_threadsafe(self._put, (obj_json, category, difficulty, future))
+        return await asyncio.wrap_future(future)
+
+    async def _drain(self):
+        while True:
+            batch = [await self.queue.get()]
+            await asyncio.sleep(self.window)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            self.loop.create_task(self._generate(batch))
+
+    async def _generate(self, batch):
+        entries = [item[:3] for item in batch]
+        futures = [item[3] for item in batch]
+        results = await self._generate_quizzes(entries)
+        for future, result in zip(futures, results):
+            # The waiting request may have been cancelled in the meantime
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _generate_quizzes(self, entries):
+        """Returns a quiz, or the exception its own GPT call raised, per entry."""
+        quizzes = {}
+        if len(entries) > 1:
+            try:
+                result = await request_quiz(build_batch_gpt_prompt(entries))
+            except Exception:
+                # A failed batch call costs a retry, not every request in it
+                app.logger.warning(
+                    "Batched GPT call failed; retrying entries one at a time", exc_info=True
+                )
+                result = None
+            items = result.get("quizzes") if isinstance(result, dict) else None
+
+            # Match quizzes to inputs by id rather than trusting GPT's ordering
+            for item in items if isinstance(items, list) else []:
+                if is_valid_quiz(item) and type(item.get("id")) is int:
+                    quizzes.setdefault(item.pop("id"), item)
+
+        # GPT dropped or garbled some entries; retry those one at a time
+        missing = [i for i in range(len(entries)) if i not in quizzes]
+        retried = await asyncio.gather(
+            *(request_quiz(build_gpt_prompt(*entries[i])) for i in missing),
+            return_exceptions=True,
+        )
+        quizzes.update(zip(missing, retried))
+        return [quizzes[i] for i in range(len(entries))]
+
+
+quiz_batcher = QuizBatcher(llm_loop)
 
-    # New index of the correct answer after shuffling
-    try:
-        correct_index = shuffled_options.index(correct_answer)
-    except ValueError:
-        # Safety fallback: if for some reason the correct answer vanished,
-        # just force the first option to be correct.
-        shuffled_options[0] = correct_answer
-        correct_index = 0
+
+@app.route("/quiz", methods=["POST"])
+async def quiz():
+    if "image" not in request.files:
+        return jsonify({"error": "image required"}), 400
+
+    image = request.files["image"]
+    difficulty = request.form.get("difficulty", DEFAULT_DIFFICULTY).strip().title()
+    category = request.form.get("category", DEFAULT_CATEGORY)
+
+    if difficulty not in DIFFICULTIES or category not in CATEGORIES:
+        return jsonify({"error": "invalid difficulty or category"}), 400
+
+    # 1. Gemini describes the exact object
+    image_bytes = read_upload(image, request.content_length or 0)
+    image_hash = hashlib.sha256(image_bytes).digest()
+    quiz_key = (image_hash, category, difficulty)
+    quiz = await quiz_cache.get(quiz_key)
+
+    # Same image and settings as a recent request: skip straight to shuffling
+    if quiz is None:
+        obj, cacheable = await run_on_llm_loop(
+            describe_image(image_bytes, image.mimetype, image_hash)
+        )
+
+        # 2. GPT creates quiz + hint
+        # GPT will ALWAYS put the correct answer as the FIRST option.
+        # We'll shuffle them afterwards and compute the new correct_index.
+        # The description is serialized once here and reused by every prompt.
+        quiz = await quiz_batcher.generate(orjson.dumps(obj).decode(), category, difficulty)
+
+        # A quiz built from the fallback description isn't cached either, so
+        # the next upload retries Gemini instead of reusing it for 24 h
+        if cacheable and is_valid_quiz(quiz):
+            await quiz_cache.put(quiz_key, quiz)
+
+    # 3. Shuffle options while tracking the correct answer index
+    if not is_valid_quiz(quiz):
+        return jsonify({"error": "LLM did not return enough options"}), 500
+    options = quiz["options"]
+
+    # We assume the FIRST option is correct before shuffling.
+    # Shuffle the wrong answers, then drop the correct one into a random
+    # slot; this is still a uniform shuffle and tracks the answer by position
+    # even when GPT repeats an option. `options` may belong to a cached quiz,
+    # so it is never shuffled in place.
+    shuffled_options = options[1:]
+    random.shuffle(shuffled_options)
+    correct_index = random.randrange(len(options))
+    shuffled_options.insert(correct_index, options[0])
 
     # Build final quiz with shuffled answers and correct answer index
     final_quiz = {
@@ -316,10 +755,20 @@ Generate the quiz now.
     }
 
     # Save quiz to quiz.json (after shuffling, including answer index)
-    with open("quiz.json", "w", encoding="utf-8") as f:
-        f.write(json.dumps(final_quiz, indent=2, ensure_ascii=False))
+    await persist_json("quiz.json", final_quiz)
 
     return jsonify(final_quiz)
 
+
+# Serve with hypercorn instead of the Werkzeug dev server, e.g.
+#   hypercorn quiz:app --workers 4 --worker-class asyncio -b 0.0.0.0:5000
+# hypercorn runs WSGI apps itself, handling requests concurrently on a
+# thread pool.
 if __name__ == "__main__":
-    app.run(port=5000)
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = ["127.0.0.1:5000"]
+    config.wsgi_max_body_size = MAX_UPLOAD_BYTES
+    asyncio.run(serve(app, config, mode="wsgi"))